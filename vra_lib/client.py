@@ -1,66 +1,161 @@
 import json
 import os
+import random
+import sys
+from urllib.parse import urlencode
+import eventlet
 import requests
 import logging
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 from requests.exceptions import ConnectionError
 from requests.exceptions import ConnectTimeout
+from requests.packages.urllib3.util.retry import Retry
 from vra_lib.synchronization import Scheduler
-from vra_exceptions import HttpUnsuccessfulException
+from vra_lib.synchronization import enable_eventlet
+from vra_lib.vra_exceptions import HttpUnsuccessfulException
 
 # Eventlet Best Practices
 # https://specs.openstack.org/openstack/openstack-specs/specs/eventlet-best-practices.html
 if not os.environ.get('DISABLE_EVENTLET_PATCHING'):
-    import eventlet
-    eventlet.monkey_patch()
+    enable_eventlet()
+
+try:
+    import orjson
+    _parse_json = orjson.loads
+except ImportError:
+    _parse_json = json.loads
 
 
 LOG = logging.getLogger(__name__)
 
 class RetryPolicy(object):
+    """ Re-authenticates and repeats requests rejected with a client error.
+        Connection failures and transient server errors are retried with
+        backoff by the session adapter (see VraClient.RETRY_STATUSES)
+    """
 
     def __call__(self, func):
 
         def decorator(self, *args, **kwargs):
-            function = "{}.{}".format(self.__class__.__name__, func.__name__)
-            pattern_retry = "Retrying connection ({}/{}) with timeout {}s for {}"
+            pattern_retry = "Retrying request (%d/%d) after login for %s.%s"
             pattern_error = "HTTP Response URL={} Code={} Reason={} Content={}"
 
             until = self._config.connection_retries
-            pause = self._config.connection_retries_seconds
             logger = self.logger
 
-            info = "Login"
-            if 'path' not in kwargs or 'login' not in kwargs.get('path'):
-                info = "Function {} Arguments {}".format(function, str(kwargs))
+            login = 'login' in kwargs.get('path', '')
 
-            last_err = None            
+            def info():
+                if login:
+                    return "Login"
+                return "Function {}.{} Arguments {}".format(
+                    self.__class__.__name__, func.__name__, str(kwargs))
+
+            last_err = None
             for attempt in range(1, until + 1):
                 try:
                     response = func(self, *args, **kwargs)
-                    if 200 <= response.status_code < 300 or response.status_code == 404:
-                        return response
-                    last_err = pattern_error.format(response.url, response.status_code,
-                                                    response.reason, response.content)
-                    if response.status_code >= 400 and response.status_code < 500:
-                        if "Login" in info:
-                            raise HttpUnsuccessfulException(last_err)
-                        self.login()
-                        continue
-                    if response.status_code >= 300:
-                        raise HttpUnsuccessfulException(last_err)
-                    return response
                 except (HTTPError, ConnectionError, ConnectTimeout) as err:
-                    last_err = err
-                    logger.error("Request={} Response={}".format(info, last_err))
+                    logger.error("Request=%s Response=%s", info(), err)
+                    raise Exception(info(), err)
+                if 200 <= response.status_code < 300 or response.status_code == 404:
+                    return response
+                last_err = pattern_error.format(response.url, response.status_code,
+                                                response.reason, response.content)
+                if response.status_code >= 400 and response.status_code < 500:
+                    if login:
+                        raise HttpUnsuccessfulException(last_err)
+                    logger.info(pattern_retry, attempt, until,
+                                self.__class__.__name__, func.__name__)
+                    self.login()
+                    continue
+                if response.status_code >= 300:
+                    raise HttpUnsuccessfulException(last_err)
+                return response
+            raise Exception(info(), last_err)
+
+        return decorator
+
+
+class JitteredRetry(Retry):
+    """ urllib3 Retry drawing each backoff at random between zero and the
+        capped exponential backoff (full jitter), so clients failing
+        together do not retry in lockstep
+    """
+    MAX_BACKOFF = 60
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        return random.uniform(0, min(self.MAX_BACKOFF, backoff))
+
+
+class CoalescePolicy(object):
+    """ Shares the response of an identical GET already in flight with
+        concurrent callers instead of sending the request again.
+        Requests are only coalesced when running on green sockets.
+    """
+
+    def __call__(self, func):
+
+        def decorator(self, path, params=None):
+            inflight = self._inflight
+            if inflight is None:
+                return func(self, path=path, params=params)
 
-                logger.info(pattern_retry.format(attempt, until, pause, function))
-                eventlet.sleep(pause)
-            raise Exception(info, last_err)
+            query = params
+            if params and not isinstance(params, (str, bytes)):
+                query = urlencode(params, doseq=True)
+            key = (path, query or None)
+
+            event = inflight.get(key)
+            if event is not None:
+                response = event.wait()
+                if response is None:
+                    # The first caller was cancelled, send it again
+                    return decorator(self, path, params)
+                return response
+
+            event = inflight[key] = eventlet.event.Event()
+            try:
+                response = func(self, path=path, params=params)
+            except Exception:
+                event.send_exception(*sys.exc_info())
+                raise
+            except BaseException:
+                # Cancelled by eventlet.Timeout or GreenletExit, which
+                # belong to this caller only; wake the waiters to retry
+                event.send(None)
+                raise
+            finally:
+                del inflight[key]
+            event.send(response)
+            return response
 
         return decorator
 
 
+class ThrottledHTTPAdapter(HTTPAdapter):
+    """ HTTPAdapter admitting new requests through a Scheduler
+
+        Only the start of a request is throttled, so slow responses do not
+        hold back new ones. Retries done by urllib3 below the adapter are
+        not throttled again.
+
+        Keyword arguments:
+        scheduler -- the Scheduler limiting the rate of requests
+    """
+
+    def __init__(self, scheduler, **kwargs):
+        self.scheduler = scheduler
+        super(ThrottledHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        with self.scheduler:
+            pass
+        return super(ThrottledHTTPAdapter, self).send(request, **kwargs)
+
+
 class VraClientConfig:
     host = None
     port = None
@@ -74,6 +169,7 @@ class VraClientConfig:
     connection_throttling_rate = None
     connection_throttling_limit_seconds = None
     connection_throttling_timeout_seconds = None
+    connection_pool_size = None
     connection_query_limit = None
     connection_certificate_check = None
     cloud_zone = None
@@ -85,6 +181,8 @@ class VraClient:
     Client for vRealize Automation 8.x
     """
     LOGIN_API = "/csp/gateway/am/api/login"
+    DEFAULT_POOL_SIZE = 32
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
 
     def __init__(self, vraClientConfig):
         self._config = c = vraClientConfig
@@ -103,39 +201,60 @@ class VraClient:
             "domain": c.domain
         }
         
+        # Keep persistent TLS connections to vRA instead of handshaking
+        # on every request. Only request starts are throttled, so size the
+        # pool for concurrent requests rather than for the start rate
+        pool_size = c.connection_pool_size or self.DEFAULT_POOL_SIZE
+        retries = JitteredRetry(total=c.connection_retries,
+                                backoff_factor=c.connection_retries_seconds,
+                                status_forcelist=self.RETRY_STATUSES,
+                                respect_retry_after_header=True,
+                                raise_on_status=False)
+        adapter = ThrottledHTTPAdapter(self.api_scheduler,
+                                       pool_connections=pool_size,
+                                       pool_maxsize=pool_size,
+                                       pool_block=False,
+                                       max_retries=retries)
         self.session = requests.session()
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
         self.session.verify = c.connection_certificate_check
         if not c.connection_certificate_check:
             requests.packages.urllib3.disable_warnings()
         self.timeout = c.connection_timeout_seconds
+        # Greenthreads only switch on I/O, so the map needs no lock
+        self._inflight = None
+        if eventlet.patcher.is_monkey_patched('socket'):
+            self._inflight = {}
         
 
     def _get_url(self, path):
-        return "{}{}".format(self.base_url, path)
+        return self.base_url + path
+
+    @CoalescePolicy()
+    @RetryPolicy()
+    def get(self, path, params=None):
+        return self.session.get(url=self._get_url(path), params=params)
 
     @RetryPolicy()
-    def get(self, path):
-        with self.api_scheduler:
-            return self.session.get(url=self._get_url(path))
+    def head(self, path, params=None):
+        return self.session.head(url=self._get_url(path), params=params)
 
     @RetryPolicy()
     def delete(self, path):
-        with self.api_scheduler:
-            return self.session.delete(url=self._get_url(path))
+        return self.session.delete(url=self._get_url(path))
 
     @RetryPolicy()
     def post(self, path, json):
-        with self.api_scheduler:
-            return self.session.post(url=self._get_url(path), json=json)
+        return self.session.post(url=self._get_url(path), json=json)
 
     @RetryPolicy()
     def put(self, path, json):
-        with self.api_scheduler:
-            return self.session.put(url=self._get_url(path), json=json)
+        return self.session.put(url=self._get_url(path), json=json)
 
     def login(self):
-        self.logger.info("Acquiring vRA token from {} ...".format(self.base_url))
-        content = json.loads(self.post(path=self.LOGIN_API, json=self.loginDetails).content)
+        self.logger.info("Acquiring vRA token from %s ...", self.base_url)
+        content = _parse_json(self.post(path=self.LOGIN_API, json=self.loginDetails).content)
         self.session.headers.update({
             'Authorization': 'Bearer {}'.format(content.get("cspAuthToken"))
         })
@@ -1,18 +1,28 @@
 """
 Synchronization - classes related concurrent execution scheduling and limits
 """
-import os
 import time
 import functools
-import collections
 import logging
+import threading
 from enum import Enum
-if not os.environ.get('DISABLE_EVENTLET_PATCHING'):
-    import eventlet
-    eventlet.monkey_patch()
+import eventlet
+from vra_lib.vra_exceptions import SchedulerTimeoutError
 
 LOG = logging.getLogger(__name__)
 
+# Rates from which throttling is skipped altogether
+UNTHROTTLED_RATE = 10000
+# Sleeps up to this many seconds only yield instead of arming a timer
+MIN_SLEEP_SECONDS = 0.001
+
+
+def enable_eventlet():
+    """ Patches socket, select and time for cooperative greenthreads.
+        Schedulers created afterwards use eventlet primitives.
+    """
+    eventlet.monkey_patch(socket=True, select=True, time=True)
+
 
 class Scheduler(object):
     """ Synchronization.Scheduler.class limits the rate of execution of
@@ -21,56 +31,134 @@ class Scheduler(object):
         Keyword arguments:
         rate -- the rate of execution
         limit -- the limit of execution
+        disabled -- admit every execution without throttling
     """
+    __slots__ = ('schedule', 'idx', 'rate', 'limit', 'timeout', 'log',
+                 'callback', '_semaphore', '_sleep', '_lock')
+
+    def __new__(cls, rate=1, limit=1.0, timeout=1, logger=None,
+                disabled=False):
+        if cls is Scheduler and (disabled or rate >= UNTHROTTLED_RATE):
+            cls = _NullScheduler
+        return super(Scheduler, cls).__new__(cls)
 
-    def __init__(self, rate=1, limit=1.0, timeout=1, logger=None):
+    def __init__(self, rate=1, limit=1.0, timeout=1, logger=None,
+                 disabled=False):
 
         if limit <= 0:
             raise ValueError('Schedule limit "{}" not positive'.format(limit))
         if rate <= 0:
             raise ValueError('Schedule rate "{}" not positive'.format(rate))
 
-        self.schedule = collections.deque()
+        # Start times of the last 'rate' operations, oldest at 'idx'
+        self.schedule = [float('-inf')] * rate
+        self.idx = 0
 
         self.rate = rate
         self.limit = limit
         self.timeout = timeout
         self.log = logger if logger else LOG
 
-        # Callback reporting the limit was hit
-        def callback(seconds):
-            LOG.warning('Vra API Limit {:d}/s was hit. Sleeping for {:f}s.'
-                        .format(limit, seconds))
-
-        self.callback = callback
-        self._semaphore = eventlet.semaphore.Semaphore(value=self.rate)
+        self.callback = self._on_limit_hit
+        if eventlet.patcher.is_monkey_patched('socket'):
+            self._semaphore = eventlet.semaphore.Semaphore(value=self.rate)
+            self._sleep = eventlet.greenthread.sleep
+            # Greenthreads never yield while reserving start times
+            self._lock = None
+        else:
+            self._semaphore = threading.Semaphore(value=self.rate)
+            self._sleep = time.sleep
+            self._lock = threading.Lock()
 
     def __call__(self, func):
+        enter = self.__enter__
+        exit_ = self.__exit__
+
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
-            with self:
+            enter()
+            try:
                 return func(*args, **kwargs)
+            finally:
+                exit_(None, None, None)
         return wrapped
 
+    def _on_limit_hit(self, seconds):
+        """ Default callback reporting the limit was hit """
+        if self.log.isEnabledFor(logging.WARNING):
+            self.log.warning('Vra API Limit %d per %ss was hit. '
+                             'Sleeping for %fs.', self.rate, self.limit, seconds)
+
+    def _reserve(self, n):
+        """ Reserves the next n start times and returns the delay in
+            seconds until each of them
+        """
+        lock = self._lock
+        if lock is not None:
+            lock.acquire()
+        try:
+            schedule = self.schedule
+            limit = self.limit
+            rate = self.rate
+            idx = self.idx
+
+            now = time.monotonic()
+            delays = []
+            for _ in range(n):
+                run_time = max(now, schedule[idx] + limit)
+                schedule[idx] = run_time
+                idx = (idx + 1) % rate
+                delays.append(run_time - now)
+            self.idx = idx
+            return delays
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def schedule_batch(self, n):
+        """ Reserves n executions at once and returns the delay in seconds
+            after which each may start, e.g. for eventlet.spawn_after.
+            Only the rate is enforced, not the concurrency of the 'with'
+            section.
+        """
+        delays = self._reserve(n)
+        if delays and delays[-1] > 0:
+            self.callback(delays[-1])
+        return delays
+
     def __enter__(self):
         if self._semaphore.acquire(blocking=True, timeout=self.timeout):
-            run_time = time.time()
-            offset = len(self.schedule) - self.rate
-
-            if offset >= 0 and run_time - self.limit < self.schedule[offset]:
-                sleeptime = run_time - self.schedule[offset] + self.limit
-                if self.callback:
-                    eventlet.spawn(self.callback, sleeptime)
-                eventlet.greenthread.sleep(sleeptime)
-                run_time = self.schedule[offset] + self.limit
-            self.schedule.append(run_time)
+            # Reserve the slot before yielding, so callers entering while
+            # this one sleeps queue up behind it instead of reusing it
+            sleeptime = self._reserve(1)[0]
+
+            if sleeptime > 0:
+                if sleeptime > MIN_SLEEP_SECONDS:
+                    self.callback(sleeptime)
+                    self._sleep(sleeptime)
+                else:
+                    self._sleep(0)
             return self
-        raise Exception("{} Queue Size={}, Rate={}, Limit={}, Timeout={}"\
-            .format("Timeout reached of trying to schedule operation.",
-                    len(self.schedule), self.rate, self.limit, self.timeout))
+        raise SchedulerTimeoutError(self.rate, self.limit, self.timeout)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._semaphore.release()
-        now = time.time()
-        while self.schedule and self.schedule[0] < now - self.limit:
-            self.schedule.popleft()
+
+
+class _NullScheduler(Scheduler):
+    """ Scheduler admitting every execution immediately, used when
+        throttling is disabled
+    """
+    __slots__ = ()
+
+    def __call__(self, func):
+        return func
+
+    def schedule_batch(self, n):
+        return [0.0] * n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
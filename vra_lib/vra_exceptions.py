@@ -1,5 +1,27 @@
 class HttpUnsuccessfulException(Exception):
     """vRA http exception handler"""
     def __init__(self, message):
-        self.message = message
-        super(HttpUnsuccessfulException, self).__init__(self.message)
+        super(HttpUnsuccessfulException, self).__init__(message)
+
+    @property
+    def message(self):
+        return self.args[0] if self.args else ''
+
+    @message.setter
+    def message(self, message):
+        self.args = (message,) + self.args[1:]
+
+
+class SchedulerTimeoutError(Exception):
+    """Scheduler timed out waiting for a free execution slot"""
+
+    def __init__(self, rate, limit, timeout):
+        self.rate = rate
+        self.limit = limit
+        self.timeout = timeout
+        super(SchedulerTimeoutError, self).__init__(rate, limit, timeout)
+
+    def __str__(self):
+        return ("Timeout reached of trying to schedule operation. "
+                "Rate={}, Limit={}, Timeout={}"
+                .format(self.rate, self.limit, self.timeout))